@@ -9,41 +9,43 @@ $> ./tiktok_archiver.py --save likes {archive_path} {output_path}
 """
 import argparse
 import dataclasses
-import datetime
+import json
 import pathlib
-import subprocess
+import re
 import sys
-import tempfile
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 from functools import partial
-from multiprocessing import dummy
-from typing import List
+from typing import Callable, Dict, List, Optional, Set
 
+import yt_dlp
 
-@dataclasses.dataclass
-class Video:
-    """
-    A TikTok video as represented in a user data export.
+# Matches the link line of each video in a video list file
+_LINK_RE = re.compile(r"^Video Link:([^\r\n]*)", re.MULTILINE)
 
-    `link` is a URL to the TikTok video.
-    `datetime` is the date associated with the video in the user data export.
-    """
+# Matches the ID of the TikTok video in a video link
+_VIDEO_ID_RE = re.compile(r"/video/(\d+)")
 
-    link: str
-    datetime: str
+# Characters to strip out of video links
+_LINK_STRIP = str.maketrans("", "", " \n\r\t")
 
-    def __post_init__(self):
-        self._clean_link()
-        self._clean_datetime()
+# The location of each video list file in a user data export
+_VIDEO_FILES = {
+    "favourites": "Activity/Favorite Videos.txt",
+    "likes": "Activity/Like List.txt",
+    "uploads": "Videos/Videos.txt",
+    "history": "Activity/Video Browsing History.txt",
+}
 
-    def _clean_link(self):
-        self.link = self.link.replace(" ", "").replace("\n", "")
+# The file in the output directory used to cache the videos discovered in an archive
+_CACHE_FILE = ".archive_cache.json"
 
-    def _clean_datetime(self):
-        self.datetime = datetime.datetime.strptime(
-            self.datetime.replace("\n", "").strip(),
-            "%Y-%m-%d %H:%M:%S",
-        ).isoformat()
+
+def _clean_link(raw: str) -> str:
+    """Remove any surrounding whitespace from a video link in a user data export."""
+    return raw.translate(_LINK_STRIP)
 
 
 @dataclasses.dataclass
@@ -51,16 +53,22 @@ class ArchiveVideos:
     """
     The TikTok video collections as represented in a user data export.
 
-    `favourites` is the list of TikTok videos the user has favourited.
-    `likes` is the list of TikTok videos the user has liked.
-    `uploads` is the list of TikTok videos the user has uploaded.
-    `history` is the list of TikTok videos the user has viewed.
+    `favourites` is the list of links to TikTok videos the user has favourited.
+    `likes` is the list of links to TikTok videos the user has liked.
+    `uploads` is the list of links to TikTok videos the user has uploaded.
+    `history` is the list of links to TikTok videos the user has viewed.
     """
 
-    favourites: List[Video]
-    likes: List[Video]
-    uploads: List[Video]
-    history: List[Video]
+    favourites: List[str]
+    likes: List[str]
+    uploads: List[str]
+    history: List[str]
+
+
+def _video_id(link: str) -> Optional[str]:
+    """Find the ID of the TikTok video in a link, or `None` if the link has no ID."""
+    match = _VIDEO_ID_RE.search(link)
+    return match.group(1) if match else None
 
 
 def _init_argparse():
@@ -99,112 +107,224 @@ def _init_argparse():
     return args
 
 
-def extract_archvie(archive_path: pathlib.Path) -> pathlib.Path:
+def extract_archvie(archive_path: pathlib.Path) -> Dict[str, str]:
     """
-    Extract a user data archive to a temporary directory.
+    Read the video list files out of a user data archive.
 
-    If the user supplied a path to an already unzipped archive, this is a no-op and will
-    return the same path. Otherwise, the archive is unzipped to a system temporary
-    directory and that path is returned.
+    The user can supply either a path to the archive zip file or to an already unzipped
+    archive. Only the video list files are read, rather than extracting the whole
+    archive, and they are returned as a mapping of their path in the archive to their
+    contents. Any video list files missing from the archive are left out.
     """
     if archive_path.is_dir():
-        return archive_path
+        return _read_video_files(partial(_read_file, archive_path))
 
     if archive_path.is_file():
-        temp_dir = tempfile.mkdtemp()
-
         with zipfile.ZipFile(archive_path) as zfile:
-            zfile.extractall(temp_dir)
-
-        return pathlib.Path(temp_dir)
+            return _read_video_files(partial(_read_member, zfile))
 
     raise ValueError(f"{archive_path} is not a directory or zip file")
 
 
-def discover_videos(archive_path: pathlib.Path) -> ArchiveVideos:
+def _read_video_files(read: Callable[[str], Optional[str]]) -> Dict[str, str]:
+    """
+    Read all the video list files with `read`, which returns `None` for missing files.
+
+    The files are read in a thread pool so a large video list file, like the browsing
+    history, does not hold up reading the others.
     """
-    Read the video history files in a user data export to discover the favourites,
+    with ThreadPoolExecutor(max_workers=len(_VIDEO_FILES)) as executor:
+        futures = {name: executor.submit(read, name) for name in _VIDEO_FILES.values()}
+
+    files: Dict[str, str] = {}
+    for name, future in futures.items():
+        text = future.result()
+        if text is not None:
+            files[name] = text
+    return files
+
+
+def _read_file(archive_path: pathlib.Path, name: str) -> Optional[str]:
+    """Read a file from an unzipped user data archive."""
+    file_path = archive_path / name
+    if not file_path.is_file():
+        return None
+    return file_path.read_text(encoding="utf-8")
+
+
+def _read_member(zfile: zipfile.ZipFile, name: str) -> Optional[str]:
+    """Read a file from a user data archive zip file."""
+    try:
+        return zfile.read(name).decode("utf-8")
+    except KeyError:
+        return None
+
+
+def discover_videos(files: Dict[str, str]) -> ArchiveVideos:
+    """
+    Read the video history files from a user data export to discover the favourites,
     likes, uploads, and history lists.
     """
     return ArchiveVideos(
-        favourites=read_videos(archive_path / "Activity" / "Favorite Videos.txt"),
-        likes=read_videos(archive_path / "Activity" / "Like List.txt"),
-        uploads=read_videos(archive_path / "Videos" / "Videos.txt"),
-        history=read_videos(archive_path / "Activity" / "Video Browsing History.txt"),
+        **{
+            field: read_links(files.get(name, ""))
+            for field, name in _VIDEO_FILES.items()
+        }
     )
 
 
-def read_videos(file_path: pathlib.Path) -> List[Video]:
-    """Read a video history file and return a list of all the listed videos."""
-    videos: List[Video] = []
-    date_time = None
-    link = None
+def load_videos(archive_path: pathlib.Path, cache_path: pathlib.Path) -> ArchiveVideos:
+    """
+    Discover the videos in a user data export, caching the result in `cache_path`.
 
-    if not file_path.is_file():
-        return videos
+    The cache is keyed on the archive zip file's path, modification time, and size, so
+    re-running against the same archive skips reading and parsing it again. Already
+    unzipped archives are cheap to read and are not cached.
+    """
+    if not archive_path.is_file():
+        return discover_videos(extract_archvie(archive_path))
 
-    with open(file_path) as path:
-        # TODO: Maybe use a state machine to parse the video files more reliably
-        for line in path.readlines():
-            if line.startswith("Date: "):
-                date_time = line.split(":", 1)[1]
-            elif line.startswith("Video Link:"):
-                link = line.split(":", 1)[1]
+    stat = archive_path.stat()
+    key = [str(archive_path.resolve()), stat.st_mtime_ns, stat.st_size]
 
-            if date_time and link:
-                videos.append(Video(datetime=date_time, link=link))
-                date_time = None
-                link = None
+    try:
+        cache = json.loads(cache_path.read_text(encoding="utf-8"))
+        if cache["key"] == key:
+            return ArchiveVideos(**cache["videos"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
 
-    return videos
+    archive_videos = discover_videos(extract_archvie(archive_path))
 
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    cache_path.write_text(
+        json.dumps({"key": key, "videos": dataclasses.asdict(archive_videos)}),
+        encoding="utf-8",
+    )
+    return archive_videos
 
-def download_videos(videos: List[Video], output: pathlib.Path, threads: int = 20):
+
+def read_links(text: str) -> List[str]:
+    """Read the contents of a video history file and return links to the videos."""
+    return [_clean_link(link) for link in _LINK_RE.findall(text)]
+
+
+def download_videos(
+    links: List[str],
+    output: pathlib.Path,
+    threads: int = 20,
+    seen: Optional[Set[str]] = None,
+):
     """
     Download a list of TikTok videos into an output directory.
 
-    `threads` controlls the number of parrallel instances of youtube-dl used to download
-    TikTok videos. More threads better saturate available network and disk bandwidth but
+    `threads` controlls the number of parrallel yt-dlp downloads used to download TikTok
+    videos. More threads better saturate available network and disk bandwidth but
     increases the likley hood that TikTok throttles or temporarily bans our connections.
+
+    Videos that have already been downloaded into `output`, for example by an earlier
+    run, are skipped without asking yt-dlp to download them.
+
+    `seen` is the set of videos already downloaded to other lists. These videos, and any
+    repeats within `links`, are skipped. `seen` is updated with the videos in `links` so
+    it can be passed along to the next call.
     """
-    print(f"Downloading {len(videos)} videos to {output.absolute()}", file=sys.stderr)
-
-    # Build a list of each individual youtube-dl command to run
-    commands = [
-        [
-            "youtube-dl",
-            "--write-info-json",
-            "--ignore-errors",
-            "--output",
-            f"{output}/%(id)s.%(ext)s",
-            video.link,
-        ]
-        for video in videos
-    ]
-
-    # Run each of the youtube-dl tasks in a thread pool
-    results: List[subprocess.CompletedProcess] = dummy.Pool(threads).imap(
-        partial(subprocess.run, capture_output=True, text=True), commands
-    )
+    links = _pending_links(links, output, seen if seen is not None else set())
+    if not links:
+        return
+
+    print(f"Downloading {len(links)} videos to {output.absolute()}", file=sys.stderr)
+
+    # Each thread gets its own `YoutubeDL`, which is set up the first time the thread
+    # downloads a video and then reused for the rest of its downloads. `YoutubeDL` keeps
+    # and modifies the params it is given, so each one gets its own copy.
+    params = {
+        "outtmpl": f"{output}/%(id)s.%(ext)s",
+        "writeinfojson": True,
+        "quiet": True,
+        "no_warnings": True,
+        "noprogress": True,
+        "logger": _QuietLogger(),
+    }
+    local = threading.local()
+
+    def download(link: str):
+        if not hasattr(local, "ydl"):
+            local.ydl = ydl_stack.enter_context(yt_dlp.YoutubeDL(dict(params)))
+        local.ydl.extract_info(link)
+
+    # Run each of the downloads in a thread pool and display details of each result as
+    # soon as it completes, then close each thread's `YoutubeDL` once the pool is done
+    with ExitStack() as ydl_stack, ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(download, link): link for link in links}
+
+        done_count = 0
+        for future in as_completed(futures):
+            done_count += 1
+            link = futures[future]
+            try:
+                future.result()
+            except Exception as exc:  # pylint: disable=broad-except
+                # Errors only fail this one video, like youtube-dl's `--ignore-errors`
+                error = str(exc).split("\n", 1)[0] or repr(exc)
+                print(
+                    (
+                        f"Dowloading ({done_count}/{len(links)}) {link}\t"
+                        f"FAILED ❌: \n\t{error}"
+                    ),
+                    file=sys.stderr,
+                )
+            else:
+                print(
+                    f"Dowloading ({done_count}/{len(links)}) {link}\tDONE ✅",
+                    file=sys.stderr,
+                )
+
+
+def _pending_links(links: List[str], output: pathlib.Path, seen: Set[str]) -> List[str]:
+    """
+    Filter out the videos `download_videos` should skip, and update `seen` to include
+    the videos in `links`.
+    """
+    unique = []
+    for link in links:
+        key = _video_id(link) or link
+        if key not in seen:
+            seen.add(key)
+            unique.append(link)
+    if len(unique) < len(links):
+        print(f"Skipping {len(links) - len(unique)} duplicate videos", file=sys.stderr)
+    links = unique
+
+    downloaded = {path.stem for path in output.glob("*.mp4")}
+    pending = [link for link in links if _video_id(link) not in downloaded]
+    if len(pending) < len(links):
+        print(
+            (
+                f"Skipping {len(links) - len(pending)} videos already downloaded to "
+                f"{output.absolute()}"
+            ),
+            file=sys.stderr,
+        )
+    return pending
+
+
+class _QuietLogger:
+    """
+    A yt-dlp logger that discards all of yt-dlp's output.
 
-    # Wait for each subprocess to complete and display details of the result
-    done_count = 0
-    for result in results:
-        done_count += 1
-        if result.returncode == 0:
-            print(
-                f"Dowloading ({done_count}/{len(videos)}) {result.args[-1]}\tDONE ✅",
-                file=sys.stderr,
-            )
-        else:
-            error = result.stderr.split("\n", 1)[0]
-            print(
-                (
-                    f"Dowloading ({done_count}/{len(videos)}) {result.args[-1]}\t"
-                    f"FAILED ❌: \n\t{error}"
-                ),
-                file=sys.stderr,
-            )
+    Errors still get reported, as the exception raised from the download, and only the
+    first line of its message is displayed.
+    """
+
+    def debug(self, _msg: str):
+        pass
+
+    def warning(self, _msg: str):
+        pass
+
+    def error(self, _msg: str):
+        pass
 
 
 def main():
@@ -214,26 +334,34 @@ def main():
     archive_path = pathlib.Path(args.archive_path)
     output_path = pathlib.Path(args.output_path)
 
-    archive_path = extract_archvie(archive_path)
-    archive_videos = discover_videos(archive_path)
+    archive_videos = load_videos(archive_path, output_path / _CACHE_FILE)
+
+    # Each video is only downloaded once, into the first list it is saved from
+    seen: Set[str] = set()
 
     if "favourites" in args.save:
         if archive_videos.favourites:
             download_videos(
-                archive_videos.favourites, output_path / "favourites", args.jobs
+                archive_videos.favourites, output_path / "favourites", args.jobs, seen
             )
 
     if "likes" in args.save:
         if archive_videos.likes:
-            download_videos(archive_videos.likes, output_path / "likes", args.jobs)
+            download_videos(
+                archive_videos.likes, output_path / "likes", args.jobs, seen
+            )
 
     if "uploads" in args.save:
         if archive_videos.uploads:
-            download_videos(archive_videos.uploads, output_path / "uploads", args.jobs)
+            download_videos(
+                archive_videos.uploads, output_path / "uploads", args.jobs, seen
+            )
 
     if "history" in args.save:
         if archive_videos.history:
-            download_videos(archive_videos.history, output_path / "history", args.jobs)
+            download_videos(
+                archive_videos.history, output_path / "history", args.jobs, seen
+            )
 
 
 if __name__ == "__main__":